@@ -6,12 +6,16 @@ from . import __version__
 import os
 import sys
 import stat
+import time
 import etcd
 import errno
 import logging
 import argparse
 import posixpath
-from boltons.funcutils import wraps
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache, TTLCache
+from functools import wraps
 from fuse import FUSE, Operations, LoggingMixIn, FuseOSError
 
 try:
@@ -19,13 +23,42 @@ try:
 except ImportError:
     import urlparse
 
+try:
+    from functools import lru_cache
+except ImportError:
+    from cachetools.func import lru_cache
+
 log = logging.getLogger(__name__)
 fuselog = logging.getLogger("fuse.log-mixin")
 
 DESCRIPTION = "Filesystem based on etcd"
+# Number of filesystem path to etcd key conversions that are cached
+PATH_CACHE_SIZE = 8192
+# Bounds of the in-memory cache of node attributes. Entries are kept
+# coherent by watching etcd, the TTL only limits staleness if the watch lags.
+ATTR_CACHE_SIZE = 4096
+ATTR_CACHE_TTL = 30.0
+# Total size in bytes of the values of open files kept in memory
+READ_CACHE_SIZE = 64 * 1024 * 1024
+# Number of subdirectories that are prefetched in parallel, and the most
+# that may be queued or in flight at any time
+PREFETCH_WORKERS = 16
+PREFETCH_MAX_PENDING = 64
+# Watch requests are renewed every WATCH_TIMEOUT seconds and retried after
+# WATCH_RETRY_INTERVAL seconds on failure
+WATCH_TIMEOUT = 60
+WATCH_RETRY_INTERVAL = 1
+# Keep-alive connections to etcd shared by concurrent FUSE operations
+ETCD_POOL_SIZE = 32
+ETCD_READ_TIMEOUT = 5
+# Size of the largest read/write request passed by the kernel
+FUSE_MAX_IO = 1024 * 1024
 LOG_FORMAT = ("%(asctime)-15s etcdfs pid=%(process)d "
               "%(module)s:%(lineno)s [%(levelname)s] %(message)s")
 
+# Actions of etcd results that remove a node
+ETCD_DELETE_ACTIONS = ("delete", "compareAndDelete", "expire")
+
 # Mapping of etcd error code to linux errno
 ETCD_CODE_TO_ERRNO = {
     # EtcdKeyNotFound
@@ -47,6 +80,22 @@ ETCD_CODE_TO_ERRNO = {
 }
 
 
+def to_bytes(value):
+    """Convert an etcd value to bytes."""
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
+
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def _path_to_key(basedir, path):
+    """Convert filesystem path to etcd key under basedir."""
+    if path == "/":
+        return basedir
+    return ((basedir.rstrip("/") + "/" + path.lstrip("/")).rstrip("/") or
+            basedir)
+
+
 def handle_etcd_errors(func):
     """Decorator to convert etcd errors to FUSE errors."""
     @wraps(func)
@@ -54,7 +103,7 @@ def handle_etcd_errors(func):
         try:
             return func(*args, **kwargs)
         except etcd.EtcdException as e:
-            payload = getattr(e, "payload", {})
+            payload = getattr(e, "payload", None) or {}
             error_code = payload.get("errorCode", None)
             if error_code:
                 _errno = ETCD_CODE_TO_ERRNO.get(error_code, errno.EINVAL)
@@ -64,54 +113,118 @@ def handle_etcd_errors(func):
     return wrapper
 
 
-class EtcdFSOperations(LoggingMixIn, Operations):
+class LazyLoggingMixIn(LoggingMixIn):
+    """LoggingMixIn that formats arguments only if debug logging is enabled.
+
+    LoggingMixIn calls repr() on the arguments of every operation, including
+    the data of write calls, even when the log record is discarded.
+    """
+
+    def __call__(self, op, path, *args):
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return getattr(self, op)(path, *args)
+        return LoggingMixIn.__call__(self, op, path, *args)
+
+
+class EtcdFSOperations(LazyLoggingMixIn, Operations):
     """FUSE Operations for etcd filesystem."""
 
-    def __init__(self, client, basedir, uid=None, gid=None, mode=0o600):
+    def __init__(self, client, basedir, uid=None, gid=None, mode=0o600,
+                 prefetch=False):
         self.client = client
         self.basedir = "/%s" % basedir.strip("/")
         self.uid = uid or os.getuid()
         self.gid = gid or os.getgid()
         self.mode = mode
+        self.prefetch = prefetch
+        # Fields of the stat struct that are the same for all nodes
+        self._file_stat_proto = {"st_mode": stat.S_IFREG | self.mode,
+                                 "st_nlink": 1,
+                                 "st_uid": self.uid,
+                                 "st_gid": self.gid}
+        self._dir_stat_proto = {"st_mode": (stat.S_IFDIR | stat.S_IXUSR |
+                                            self.mode),
+                                "st_nlink": 1,
+                                "st_uid": self.uid,
+                                "st_gid": self.gid,
+                                "st_size": 4096}
+        self._attr_cache = TTLCache(maxsize=ATTR_CACHE_SIZE,
+                                    ttl=ATTR_CACHE_TTL)
+        # Highest stale etcd index of recently changed keys, so that reads
+        # in flight during a change do not cache the old node again
+        self._tombstones = TTLCache(maxsize=ATTR_CACHE_SIZE,
+                                    ttl=ATTR_CACHE_TTL)
+        self._write_buffers = {}
+        # Files known to be empty, mapped to the etcd index at which they
+        # were emptied. Their first write does not need to read the old value.
+        self._truncated = {}
+        self._read_cache = LRUCache(maxsize=READ_CACHE_SIZE, getsizeof=len)
+        # Files whose value is being read to fill the read cache
+        self._pending_reads = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        # Directories whose entries are cached by a prefetch
+        self._prefetched_dirs = TTLCache(maxsize=ATTR_CACHE_SIZE,
+                                         ttl=ATTR_CACHE_TTL)
+        self._prefetch_pending = 0
 
     def etcd_node_to_stat(self, node):
         """Convert an etcd node to stat struct."""
         if node.dir:
-            st_mode = (stat.S_IFDIR | stat.S_IXUSR | self.mode)
-            st_size = 4096
+            st = self._dir_stat_proto.copy()
         else:
-            st_mode = (stat.S_IFREG | self.mode)
-            st_size = len(node.value)
-
-        return {"st_ino": node.createdIndex or 0,
-                "st_mode": st_mode,
-                "st_nlink": 1,
-                "st_uid": self.uid,
-                "st_gid": self.gid,
-                "st_size": st_size,
-                "st_mtime": float(node.modifiedIndex or 0),
-                "st_atime": float(node.modifiedIndex or 0),
-                "st_ctime": float(node.createdIndex or 0)}
-
-    def chmod(self, path, mode):
+            st = self._file_stat_proto.copy()
+            st["st_size"] = len(to_bytes(node.value))
+        st["st_ino"] = node.createdIndex or 0
+        st["st_mtime"] = st["st_atime"] = float(node.modifiedIndex or 0)
+        st["st_ctime"] = float(node.createdIndex or 0)
+        return st
+
+    def _not_supported(self, *args, **kwargs):
+        """Reject an operation that is not supported."""
         raise FuseOSError(errno.ENOTSUP)
 
-    def chown(self, path, uid, gid):
-        raise FuseOSError(errno.ENOTSUP)
+    chmod = chown = getxattr = ioctl = link = mknode = readlink = \
+        removexattr = rename = setxattr = symlink = _not_supported
 
     def create(self, path, mode, fi=None):
         key = self._path_to_key(path)
-        self.client.write(key, value="", prevExist=False)
+        res = self.client.write(key, value="", prevExist=False)
+        self._invalidate(key, res)
+        with self._lock:
+            self._truncated[path] = res.modifiedIndex
         return 0
 
     def destroy(self, path):
+        self._pool.shutdown(wait=False)
+        for _path in list(self._write_buffers):
+            try:
+                self.flush(_path, None)
+            except OSError as e:
+                # Keep flushing the other files
+                log.error("Failed to flush '%s' on unmount: %s", _path, e)
         return 0
 
+    @handle_etcd_errors
     def flush(self, path, fh):
+        with self._lock:
+            buf = self._write_buffers.get(path)
+            if buf is None:
+                return 0
+            value = bytes(buf)
+        key = self._path_to_key(path)
+        # Keep the buffer until etcd has the data, so that it is not lost if
+        # the write fails and is still visible to read and getattr
+        res = self.client.write(key, value=value)
+        with self._lock:
+            # Keep data written while the buffer was being sent
+            if self._write_buffers.get(path) is buf and buf == value:
+                del self._write_buffers[path]
+        self._invalidate(key, res)
         return 0
 
     def fsync(self, path, datasync, fh):
-        return 0
+        return self.flush(path, fh)
 
     def fsyncdir(self, path, datasync, fh):
         return 0
@@ -119,20 +232,23 @@ class EtcdFSOperations(LoggingMixIn, Operations):
     @handle_etcd_errors
     def getattr(self, path, fh=None):
         key = self._path_to_key(path)
-        res = self.client.read(key)
-        return self.etcd_node_to_stat(res)
-
-    def getxattr(self, path, name, position=0):
-        raise FuseOSError(errno.ENOTSUP)
+        with self._lock:
+            attrs = self._attr_cache.get(key)
+            buf = self._write_buffers.get(path)
+        if attrs is None:
+            res = self.client.read(key)
+            attrs = self._cache_node(res, key)
+        if buf is not None:
+            attrs = dict(attrs, st_size=len(buf))
+        return attrs
 
     def init(self, path):
-        return
-
-    def ioctl(self, path, cmd, arg, fip, flags, data):
-        raise FuseOSError(errno.ENOTSUP)
-
-    def link(self, target, source):
-        raise FuseOSError(errno.ENOTSUP)
+        # Threads do not survive the fork, so start watching after FUSE
+        # has daemonized
+        watcher = threading.Thread(target=self._watch_loop,
+                                   name="etcdfs-watch")
+        watcher.daemon = True
+        watcher.start()
 
     def listxattr(self, path):
         return []
@@ -140,13 +256,33 @@ class EtcdFSOperations(LoggingMixIn, Operations):
     @handle_etcd_errors
     def mkdir(self, path, mode):
         dirkey = self._path_to_key(path)
-        self.client.write(dirkey, value=None, dir=True, prevExist=False)
+        res = self.client.write(dirkey, value=None, dir=True, prevExist=False)
+        self._invalidate(dirkey, res)
         return 0
 
-    def mknode(self, path, mode, dev):
-        raise FuseOSError(errno.ENOTSUP)
-
+    @handle_etcd_errors
     def open(self, path, flags):
+        # FUSE passes O_TRUNC only if the atomic_o_trunc option is enabled.
+        # Otherwise it removes O_TRUNC from the open and truncates the file
+        # afterwards, so only read-only opens can use the read cache.
+        if flags & os.O_TRUNC:
+            return self.truncate(path, 0)
+        # Keep the value of files opened for reading for the open handle
+        if (flags & os.O_ACCMODE) == os.O_RDONLY:
+            key = self._path_to_key(path)
+            with self._lock:
+                self._pending_reads.add(path)
+            res = self.client.read(key)
+            self._ensure_key(res)
+            self._cache_node(res, key)
+            value = to_bytes(res.value)
+            with self._lock:
+                # Do not cache the value if the file changed while it was
+                # being read. Larger values are read from etcd on every call.
+                if (path in self._pending_reads and
+                        len(value) <= READ_CACHE_SIZE):
+                    self._read_cache[path] = value
+                self._pending_reads.discard(path)
         return 0
 
     def opendir(self, path):
@@ -154,79 +290,106 @@ class EtcdFSOperations(LoggingMixIn, Operations):
 
     @handle_etcd_errors
     def read(self, path, size, offset, fh):
+        with self._lock:
+            buf = self._write_buffers.get(path)
+            if buf is not None:
+                return bytes(buf[offset:offset + size])
+            cached = self._read_cache.get(path)
+        if cached is not None:
+            return cached[offset:offset + size]
         key = self._path_to_key(path)
         res = self.client.read(key)
-        return res.value[offset:offset + size]
+        self._cache_node(res, key)
+        return to_bytes(res.value)[offset:offset + size]
 
     @handle_etcd_errors
     def readdir(self, path, fh):
         dirkey = self._path_to_key(path)
+        # The v2 API always returns the values of files in a directory
+        # listing, so the attributes of the children, including their size,
+        # are cached without any further round-trips
         res = self.client.read(dirkey)
         self._ensure_dir(res)
 
+        # An empty directory lists itself as its only child
+        prefix = dirkey.rstrip("/") + "/"
+        prefix_len = len(prefix)
+        children = [_node for _node in res.children
+                    if _node.key and _node.key.startswith(prefix)]
+        cache_node = self._cache_node
         names = [".", ".."]
-        for _node in res.children:
-            if _node.key is None:
-                continue
-            key = _node.key.rstrip("/")
-            if key == dirkey:
-                continue
-            key = _node.key.replace(dirkey, "", 1).lstrip("/")
-            if not key:
-                continue
-            attrs = self.etcd_node_to_stat(_node)
-            names.append((key, attrs, 0))
+        names.extend((_node.key[prefix_len:], cache_node(_node), 0)
+                     for _node in children)
 
-        return names
+        if self.prefetch:
+            self._prefetch([_node.key for _node in children if _node.dir])
 
-    def readlink(self, path):
-        raise FuseOSError(errno.ENOTSUP)
+        return names
 
     def release(self, path, fh):
-        return 0
+        with self._lock:
+            self._drop_read_cache(path)
+            self._truncated.pop(path, None)
+        return self.flush(path, fh)
 
     def releasedir(self, path, fh):
         return 0
 
-    def removexattr(self, path, name):
-        raise FuseOSError(errno.ENOTSUP)
-
-    def rename(self, old, new):
-        raise FuseOSError(errno.ENOTSUP)
-
     @handle_etcd_errors
     def rmdir(self, path):
         key = self._path_to_key(path)
-        self.client.delete(key, dir=True)
+        res = self.client.delete(key, dir=True)
+        self._invalidate(key, res)
         return 0
 
-    def setxattr(self, path, name, value, options, position=0):
-        raise FuseOSError(errno.ENOTSUP)
-
     def statfs(self, path):
         return {}
 
-    def symlink(self, target, source):
-        raise FuseOSError(errno.ENOTSUP)
-
+    @handle_etcd_errors
     def truncate(self, path, length, fh=None):
         key = self._path_to_key(path)
+        with self._lock:
+            self._drop_read_cache(path)
+            buf = self._write_buffers.get(path)
+            if buf is not None:
+                del buf[length:]
+                buf.extend(b"\0" * (length - len(buf)))
+                return 0
+            attrs = self._attr_cache.get(key)
+        if attrs is not None and attrs["st_size"] == length:
+            return 0
+        if length == 0:
+            # No need to read a value that is discarded
+            res = self.client.write(key, value="", prevExist=True)
+            self._invalidate(key, res)
+            with self._lock:
+                self._truncated[path] = res.modifiedIndex
+            return 0
         res = self.client.read(key)
-        value = res.value
-        old_length = len(value)
+        self._ensure_key(res)
+        buf = bytearray(to_bytes(res.value))
+        old_length = len(buf)
         if old_length == length:
             return 0
         if old_length > length:
-            new_value = value[0:length]
+            del buf[length:]
         else:
-            new_value = value.ljust(length)
-        self.client.write(key, value=new_value)
+            buf.extend(b"\0" * (length - old_length))
+        res = self.client.write(key, value=bytes(buf))
+        self._invalidate(key, res)
+        with self._lock:
+            self._truncated.pop(path, None)
         return 0
 
     @handle_etcd_errors
     def unlink(self, path):
+        with self._lock:
+            self._drop_read_cache(path)
+            self._write_buffers.pop(path, None)
+            self._truncated.pop(path, None)
         key = self._path_to_key(path)
-        self.client.delete(key)
+        res = self.client.delete(key)
+        self._invalidate(key, res)
         return 0
 
     def utimens(self, path, times=None):
@@ -235,33 +398,190 @@ class EtcdFSOperations(LoggingMixIn, Operations):
 
     @handle_etcd_errors
     def write(self, path, data, offset, fh):
-        key = self._path_to_key(path)
-        value = data
-
-        # Handle updates
-        if offset:
-            try:
-                res = self.client.read(key)
-                self._ensure_key(res)
-                old_value = res.value
-                pre = old_value[0:offset].ljust(offset)
-                post = old_value[offset + len(data):]
-                value = pre + data + post
-            except etcd.EtcdKeyNotFound:
-                value = "" * offset + data
-
-        self.client.write(key, value=value)
-        return len(data)
+        # Writes are buffered in memory and sent to etcd on flush. The
+        # buffer is looked up and changed under the same lock, so that a
+        # concurrent flush cannot send it while it is being changed.
+        value = None
+        while True:
+            with self._lock:
+                buf = self._write_buffer(path, value)
+                if buf is not None:
+                    self._drop_read_cache(path)
+                    if offset > len(buf):
+                        buf.extend(b"\0" * (offset - len(buf)))
+                    buf[offset:offset + len(data)] = data
+                    return len(data)
+            value = self._read_value(path)
 
     def _path_to_key(self, path):
         """Convert filesystem path to etcd key."""
-        return posixpath.join(self.basedir, path.lstrip("/")).rstrip("/")
+        return _path_to_key(self.basedir, path)
 
     def _key_to_path(self, key, dirkey=None):
         """Convert etcdkey to filesystem relative path."""
         dirkey = dirkey or self.basedir
         return key.replace(dirkey, "", 1).lstrip("/") or "/"
 
+    def _write_buffer(self, path, value=None):
+        """Get the write buffer of a file, creating it if possible.
+
+        Must be called with the lock held. Returns None if there is no
+        buffer and the current value of the file is needed to create one.
+        """
+        buf = self._write_buffers.get(path)
+        if buf is None:
+            if self._truncated.pop(path, None) is not None:
+                value = b""
+            if value is not None:
+                buf = self._write_buffers[path] = bytearray(value)
+        return buf
+
+    def _read_value(self, path):
+        """Read the value of a file from etcd as bytes."""
+        key = self._path_to_key(path)
+        try:
+            res = self.client.read(key)
+        except etcd.EtcdKeyNotFound:
+            return b""
+        self._ensure_key(res)
+        return to_bytes(res.value)
+
+    def _cache_node(self, node, key=None):
+        """Compute the stat struct of an etcd node and cache it."""
+        attrs = self.etcd_node_to_stat(node)
+        key = key if key is not None else node.key
+        with self._lock:
+            if self._is_stale(key, node.modifiedIndex or 0):
+                return attrs
+            cached = self._attr_cache.get(key)
+            # Never replace the attributes of a newer version of the node
+            if cached is None or cached["st_mtime"] <= attrs["st_mtime"]:
+                self._attr_cache[key] = attrs
+        return attrs
+
+    def _prefetch(self, dirkeys):
+        """Cache the attributes of the entries of directories in background.
+
+        Directories that are already prefetched are skipped, and at most
+        PREFETCH_MAX_PENDING directories are queued or in flight.
+        """
+        with self._lock:
+            dirkeys = [dirkey for dirkey in dirkeys
+                       if dirkey not in self._prefetched_dirs]
+            dirkeys = dirkeys[:PREFETCH_MAX_PENDING - self._prefetch_pending]
+            for dirkey in dirkeys:
+                self._prefetched_dirs[dirkey] = True
+            self._prefetch_pending += len(dirkeys)
+        for dirkey in dirkeys:
+            self._pool.submit(self._prefetch_dir, dirkey)
+
+    def _prefetch_dir(self, dirkey):
+        """Cache the attributes of the entries of a directory."""
+        try:
+            res = self.client.read(dirkey)
+            for _node in res.get_subtree():
+                if _node.key is not None:
+                    self._cache_node(_node)
+        except etcd.EtcdException:
+            # Prefetching is best effort, readdir will fetch it again
+            with self._lock:
+                self._prefetched_dirs.pop(dirkey, None)
+        finally:
+            with self._lock:
+                self._prefetch_pending -= 1
+
+    def _drop_read_cache(self, path):
+        """Drop the cached value of a file. The lock must be held."""
+        self._read_cache.pop(path, None)
+        self._pending_reads.discard(path)
+
+    def _is_stale(self, key, index):
+        """Check if a version of a key is older than a known change.
+
+        A key is also stale if one of its directories was removed after it.
+        Must be called with the lock held.
+        """
+        while True:
+            stale_index = self._tombstones.get(key)
+            if stale_index is not None and index <= stale_index:
+                return True
+            parent = posixpath.dirname(key)
+            if parent == key:
+                return False
+            key = parent
+
+    def _invalidate(self, key, res=None):
+        """Drop cached attributes of an etcd key and its parent directory.
+
+        res is the etcd result of the change, if known. Versions of the key
+        up to it are then rejected by _cache_node.
+        """
+        with self._lock:
+            if res is not None:
+                stale_index = res.modifiedIndex
+                if res.action not in ETCD_DELETE_ACTIONS:
+                    # The version written by the change itself is current
+                    stale_index -= 1
+                if stale_index > self._tombstones.get(key, 0):
+                    self._tombstones[key] = stale_index
+            self._attr_cache.pop(key, None)
+            self._attr_cache.pop(posixpath.dirname(key), None)
+            self._prefetched_dirs.pop(key, None)
+            self._prefetched_dirs.pop(posixpath.dirname(key), None)
+
+    def _watch_loop(self):
+        """Invalidate cached data on changes made by any etcd client."""
+        index = None
+        while True:
+            try:
+                if index is None:
+                    # Watch from the current index, so that no change is
+                    # missed between watch requests. Changes before it may
+                    # have been missed, so drop everything cached.
+                    res = self.client.read(self.basedir)
+                    index = res.etcd_index + 1
+                    self._clear_caches()
+                res = self.client.watch(self.basedir, index=index,
+                                        timeout=WATCH_TIMEOUT, recursive=True)
+            except etcd.EtcdWatchTimedOut:
+                continue
+            except etcd.EtcdException as e:
+                log.warning("Watching etcd directory '%s' failed: %s",
+                            self.basedir, e)
+                index = None
+                time.sleep(WATCH_RETRY_INTERVAL)
+                continue
+            index = res.modifiedIndex + 1
+            self._invalidate_node(res)
+
+    def _clear_caches(self):
+        """Drop all cached attributes and values."""
+        with self._lock:
+            self._attr_cache.clear()
+            self._read_cache.clear()
+            self._pending_reads.clear()
+            self._prefetched_dirs.clear()
+            self._truncated.clear()
+
+    def _invalidate_node(self, node):
+        """Drop cached data of an etcd node that changed."""
+        with self._lock:
+            if node.dir and node.action in ETCD_DELETE_ACTIONS:
+                # Removing a directory affects its whole subtree
+                self._attr_cache.clear()
+                self._read_cache.clear()
+                self._pending_reads.clear()
+                self._prefetched_dirs.clear()
+                self._truncated.clear()
+            else:
+                path = "/" + self._key_to_path(node.key).lstrip("/")
+                self._drop_read_cache(path)
+                # Only changes after the file was emptied here invalidate it
+                index = self._truncated.get(path)
+                if index is not None and node.modifiedIndex > index:
+                    del self._truncated[path]
+        self._invalidate(node.key, node)
+
     def _ensure_dir(self, node):
         """Ensure that an etcd node is a directory."""
         if not node.dir:
@@ -273,7 +593,7 @@ class EtcdFSOperations(LoggingMixIn, Operations):
             raise FuseOSError(errno.EISDIR)
 
 
-def main():
+def _build_parser():
     parser = argparse.ArgumentParser(description=DESCRIPTION)
     parser.add_argument("mountpoint", metavar="MOUNT_POINT",
                         help="Mount etcd filesystem at the point"
@@ -291,19 +611,36 @@ def main():
                         help="Connect to etcd server at %(metavar)s")
     parser.add_argument("--basedir", default="/",
                         help="Mount the etcd directory %(metavar)s")
-    args = parser.parse_args()
+    parser.add_argument("--prefetch", default=False,
+                        action="store_true",
+                        help="Read the subdirectories of listed directories"
+                             " in the background to cache the attributes of"
+                             " their entries")
+    return parser
+
+
+_PARSER = _build_parser()
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(logging.Formatter(LOG_FORMAT))
 
-    lvl = logging.DEBUG if args.verbose else logging.INFO
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter(LOG_FORMAT)
-    handler.setFormatter(formatter)
-    log.addHandler(handler)
+
+def setup_logging(verbose=False):
+    """Configure logging of etcdfs and, if verbose, of FUSE operations."""
+    lvl = logging.DEBUG if verbose else logging.INFO
+    # Loggers ignore handlers that are already added, so this can be
+    # called more than once
+    log.addHandler(_LOG_HANDLER)
     log.setLevel(lvl)
 
-    if args.verbose:
-        fuselog.addHandler(handler)
+    if verbose:
+        fuselog.addHandler(_LOG_HANDLER)
         fuselog.setLevel(lvl)
 
+
+def main(argv=None):
+    args = _PARSER.parse_args(argv)
+    setup_logging(args.verbose)
+
     log.info("Initialing etcdfs. Version: %s", __version__)
 
     # Check mountpoint
@@ -319,7 +656,10 @@ def main():
     # FIXME: Add authentication and other options
     url = urlparse.urlparse(args.endpoint)
     log.info("Connecting at etcd endpoint '%s'", args.endpoint)
-    client = etcd.Client(protocol=url.scheme, host=url.hostname, port=url.port)
+    client = etcd.Client(protocol=url.scheme, host=url.hostname, port=url.port,
+                         allow_reconnect=True,
+                         read_timeout=ETCD_READ_TIMEOUT,
+                         per_host_pool_size=ETCD_POOL_SIZE)
 
     # Check base directory
     basedir = args.basedir
@@ -333,9 +673,10 @@ def main():
         sys.exit(1)
 
     # Pass control to FUSE
-    etcd_fs_ops = EtcdFSOperations(client, basedir)
+    etcd_fs_ops = EtcdFSOperations(client, basedir, prefetch=args.prefetch)
     FUSE(etcd_fs_ops, args.mountpoint,
-         foreground=args.foreground, debug=args.debug)
+         foreground=args.foreground, debug=args.debug,
+         big_writes=True, max_write=FUSE_MAX_IO, max_read=FUSE_MAX_IO)
 
     log.info("Exiting")
 
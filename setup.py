@@ -8,7 +8,8 @@ with open('README.rst') as f:
 
 requirements = [
     'fusepy',
-    'boltons',
+    'cachetools',
+    'futures; python_version < "3"',
     'python-etcd',
 ]
 
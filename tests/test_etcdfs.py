@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""Tests for etcdfs operations."""
+
+import os
+import unittest
+
+import etcd
+
+from etcdfs import etcdfs
+from etcdfs.etcdfs import EtcdFSOperations
+
+
+class FakeEtcdClient(object):
+    """In-memory emulation of the parts of etcd.Client used by etcdfs."""
+
+    def __init__(self):
+        self.index = 1
+        self.nodes = {"/": {"dir": True, "value": None, "created": 1,
+                            "modified": 1}}
+        self.calls = []
+        self.fail_writes = False
+        self.on_read = None
+        # Results or exceptions returned by successive watch calls
+        self.watch_results = []
+
+    def _node(self, key, children=True):
+        node = self.nodes[key]
+        data = {"key": key if key != "/" else None,
+                "createdIndex": node["created"],
+                "modifiedIndex": node["modified"]}
+        if node["dir"]:
+            data["dir"] = True
+            if children:
+                prefix = key.rstrip("/") + "/"
+                data["nodes"] = [self._node(k, children=False)
+                                 for k in sorted(self.nodes)
+                                 if k.startswith(prefix) and
+                                 "/" not in k[len(prefix):]]
+        else:
+            data["value"] = node["value"]
+        return data
+
+    def result(self, key, action="get"):
+        return etcd.EtcdResult(action=action, node=self._node(key))
+
+    def read(self, key, **kwargs):
+        self.calls.append(("read", key))
+        if key not in self.nodes:
+            raise etcd.EtcdKeyNotFound(payload={"errorCode": 100})
+        res = self.result(key)
+        res.etcd_index = self.index
+        # Changes made by on_read happen while the result is in flight
+        if self.on_read is not None:
+            self.on_read(key)
+        return res
+
+    def watch(self, key, index=None, **kwargs):
+        self.calls.append(("watch", key, index))
+        res = self.watch_results.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def write(self, key, value=None, dir=False, prevExist=None, **kwargs):
+        self.calls.append(("write", key, value))
+        if self.fail_writes:
+            raise etcd.EtcdException("write failed")
+        if prevExist is False and key in self.nodes:
+            raise etcd.EtcdAlreadyExist(payload={"errorCode": 105})
+        if prevExist is True and key not in self.nodes:
+            raise etcd.EtcdKeyNotFound(payload={"errorCode": 100})
+        return self.set(key, value, dir=dir)
+
+    def delete(self, key, dir=False, **kwargs):
+        self.calls.append(("delete", key))
+        if key not in self.nodes:
+            raise etcd.EtcdKeyNotFound(payload={"errorCode": 100})
+        self.index += 1
+        node = self._node(key, children=False)
+        node["modifiedIndex"] = self.index
+        del self.nodes[key]
+        return etcd.EtcdResult(action="delete", node=node)
+
+    def set(self, key, value, dir=False):
+        """Change a key without recording a call, like another client."""
+        self.index += 1
+        created = self.nodes.get(key, {}).get("created", self.index)
+        self.nodes[key] = {"dir": dir, "value": value, "created": created,
+                           "modified": self.index}
+        return self.result(key, action="set")
+
+    def value(self, key):
+        return self.nodes[key]["value"]
+
+    def count(self, op):
+        return len([call for call in self.calls if call[0] == op])
+
+
+class EtcdFSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeEtcdClient()
+        self.client.set("/base", None, dir=True)
+        self.ops = EtcdFSOperations(self.client, "/base")
+
+    def event(self, key):
+        """Deliver the watch event of the current version of a key."""
+        self.ops._invalidate_node(self.client.result(key, action="set"))
+
+
+class AttrCacheTestCase(EtcdFSTestCase):
+
+    def test_getattr_is_cached(self):
+        self.client.set("/base/f", "abc")
+        self.ops.getattr("/f")
+        self.ops.getattr("/f")
+        self.assertEqual(self.client.count("read"), 1)
+
+    def test_create_invalidates_parent(self):
+        self.ops.getattr("/")
+        self.ops.create("/f", 0o600)
+        self.assertNotIn("/base", self.ops._attr_cache)
+        self.assertEqual(self.ops.getattr("/f")["st_size"], 0)
+
+    def test_unlink_invalidates_key(self):
+        self.client.set("/base/f", "abc")
+        self.ops.getattr("/f")
+        self.ops.unlink("/f")
+        self.assertRaises(OSError, self.ops.getattr, "/f")
+
+    def test_mkdir_invalidates_key(self):
+        self.ops.getattr("/")
+        self.ops.mkdir("/d", 0o700)
+        self.assertNotIn("/base", self.ops._attr_cache)
+        self.assertTrue(self.ops.getattr("/d")["st_mode"] & 0o40000)
+
+    def test_read_in_flight_does_not_restore_deleted_key(self):
+        self.client.set("/base/f", "abc")
+
+        def on_read(key):
+            self.client.on_read = None
+            self.ops.unlink("/f")
+        self.client.on_read = on_read
+        self.ops.readdir("/", 0)
+        self.assertRaises(OSError, self.ops.getattr, "/f")
+
+    def test_read_in_flight_does_not_restore_old_version(self):
+        self.client.set("/base/f", "abc")
+
+        def on_read(key):
+            self.client.on_read = None
+            self.client.set("/base/f", "hello")
+            self.event("/base/f")
+        self.client.on_read = on_read
+        self.ops.readdir("/", 0)
+        self.assertEqual(self.ops.getattr("/f")["st_size"], 5)
+
+
+class WriteTestCase(EtcdFSTestCase):
+
+    def test_writes_are_buffered_until_flush(self):
+        self.ops.create("/f", 0o600)
+        self.ops.write("/f", b"abc", 0, 0)
+        self.ops.write("/f", b"de", 3, 0)
+        self.assertEqual(self.ops.getattr("/f")["st_size"], 5)
+        self.assertEqual(self.ops.read("/f", 10, 1, 0), b"bcde")
+        self.assertEqual(self.client.value("/base/f"), "")
+        self.ops.flush("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"abcde")
+        self.assertNotIn("/f", self.ops._write_buffers)
+
+    def test_write_past_end_pads_with_nul(self):
+        self.client.set("/base/f", "ab")
+        self.ops.write("/f", b"x", 4, 0)
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"ab\0\0x")
+
+    def test_partial_write_keeps_tail(self):
+        self.client.set("/base/f", "aaaa")
+        self.ops.write("/f", b"B", 0, 0)
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"Baaa")
+
+    def test_write_after_flush_of_other_handle(self):
+        self.client.set("/base/f", "aaaa")
+        self.ops.write("/f", b"B", 0, 0)
+        self.ops.flush("/f", 1)
+        self.ops.write("/f", b"C", 1, 0)
+        self.ops.flush("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"BCaa")
+
+    def test_failed_flush_keeps_buffer(self):
+        self.client.set("/base/f", "x")
+        self.ops.write("/f", b"Y", 0, 0)
+        self.client.fail_writes = True
+        self.assertRaises(OSError, self.ops.flush, "/f", 0)
+        self.assertEqual(self.ops.read("/f", 1, 0, 0), b"Y")
+        self.client.fail_writes = False
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"Y")
+
+
+    def test_destroy_flushes_all_buffers(self):
+        self.client.set("/base/f", "a")
+        self.client.set("/base/g", "b")
+        self.ops.write("/f", b"F", 0, 0)
+        self.ops.write("/g", b"G", 0, 0)
+        write = self.client.write
+
+        def fail_first(key, **kwargs):
+            self.client.write = write
+            raise etcd.EtcdException("write failed")
+        self.client.write = fail_first
+        self.ops.destroy("/")
+        # The failed buffer is kept and the other one is still flushed
+        self.assertEqual(len(self.ops._write_buffers), 1)
+        failed = list(self.ops._write_buffers)[0]
+        flushed = "/g" if failed == "/f" else "/f"
+        self.assertEqual(self.client.value("/base" + flushed),
+                         {"/f": b"F", "/g": b"G"}[flushed])
+
+class ReadCacheTestCase(EtcdFSTestCase):
+
+    def test_open_caches_value(self):
+        self.client.set("/base/f", "hello")
+        self.ops.open("/f", os.O_RDONLY)
+        reads = self.client.count("read")
+        self.assertEqual(self.ops.read("/f", 3, 1, 0), b"ell")
+        self.assertEqual(self.client.count("read"), reads)
+        self.ops.release("/f", 0)
+        self.assertNotIn("/f", self.ops._read_cache)
+
+    def test_open_for_writing_does_not_read(self):
+        self.client.set("/base/f", "hello")
+        self.ops.open("/f", os.O_RDWR)
+        self.ops.truncate("/f", 0)
+        self.assertEqual(self.client.count("read"), 0)
+
+    def test_write_invalidates_read_cache(self):
+        self.client.set("/base/f", "hello")
+        self.ops.open("/f", os.O_RDONLY)
+        # Written through another handle
+        self.ops.write("/f", b"J", 0, 0)
+        self.ops.flush("/f", 0)
+        self.assertEqual(self.ops.read("/f", 5, 0, 0), b"Jello")
+
+    def test_watch_event_invalidates_read_cache(self):
+        self.client.set("/base/f", "hello")
+        self.ops.open("/f", os.O_RDONLY)
+        self.client.set("/base/f", "world")
+        self.event("/base/f")
+        self.assertEqual(self.ops.read("/f", 5, 0, 0), b"world")
+
+    def test_change_during_open_is_not_cached(self):
+        self.client.set("/base/f", "hello")
+
+        def on_read(key):
+            # The watch reports a newer version while the value is read
+            self.client.on_read = None
+            self.event(key)
+        self.client.on_read = on_read
+        self.ops.open("/f", os.O_RDONLY)
+        self.assertNotIn("/f", self.ops._read_cache)
+
+class TruncateTestCase(EtcdFSTestCase):
+
+    def test_truncate_to_zero_does_not_read(self):
+        self.client.set("/base/f", "abc")
+        self.ops.truncate("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), "")
+        self.assertEqual(self.client.count("read"), 0)
+
+    def test_truncate_extends_with_nul(self):
+        self.client.set("/base/f", "abc")
+        self.ops.truncate("/f", 5)
+        self.assertEqual(self.client.value("/base/f"), b"abc\0\0")
+        self.ops.truncate("/f", 2)
+        self.assertEqual(self.client.value("/base/f"), b"ab")
+
+    def test_truncate_buffered_file(self):
+        self.client.set("/base/f", "abc")
+        self.ops.write("/f", b"d", 3, 0)
+        self.ops.truncate("/f", 2)
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"ab")
+
+    def test_sizes_are_in_bytes(self):
+        self.client.set("/base/f", u"\xe9\xe9")
+        self.assertEqual(self.ops.getattr("/f")["st_size"], 4)
+        self.ops.truncate("/f", 2)
+        self.assertEqual(self.client.value("/base/f"), b"\xc3\xa9")
+
+
+class TruncatedTestCase(EtcdFSTestCase):
+
+    def test_write_to_created_file_does_not_read(self):
+        self.ops.create("/f", 0o600)
+        self.ops.write("/f", b"abc", 0, 0)
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.count("read"), 0)
+        self.assertEqual(self.client.value("/base/f"), b"abc")
+
+    def test_own_truncate_event_keeps_mark(self):
+        self.client.set("/base/f", "abc")
+        self.ops.truncate("/f", 0)
+        self.event("/base/f")
+        self.assertIn("/f", self.ops._truncated)
+
+    def test_external_change_clears_mark(self):
+        self.client.set("/base/f", "abc")
+        self.ops.truncate("/f", 0)
+        self.client.set("/base/f", "hello")
+        self.event("/base/f")
+        self.ops.write("/f", b"x", 5, 0)
+        self.ops.release("/f", 0)
+        self.assertEqual(self.client.value("/base/f"), b"hellox")
+
+    def test_release_clears_mark(self):
+        self.ops.create("/f", 0o600)
+        self.ops.release("/f", 0)
+        self.assertNotIn("/f", self.ops._truncated)
+
+
+class ReaddirTestCase(EtcdFSTestCase):
+
+    def names(self, path):
+        return [entry if isinstance(entry, str) else entry[0]
+                for entry in self.ops.readdir(path, 0)]
+
+    def test_lists_direct_children(self):
+        self.client.set("/base/d", None, dir=True)
+        self.client.set("/base/d/g", "x")
+        self.client.set("/base/f", "abc")
+        self.assertEqual(self.names("/"), [".", "..", "d", "f"])
+        self.assertEqual(self.names("/d"), [".", "..", "g"])
+
+    def test_lists_empty_directory(self):
+        self.client.set("/base/e", None, dir=True)
+        self.assertEqual(self.names("/e"), [".", ".."])
+
+    def test_caches_children(self):
+        self.client.set("/base/f", "abc")
+        entries = self.ops.readdir("/", 0)
+        self.assertEqual(entries[2][1]["st_size"], 3)
+        reads = self.client.count("read")
+        self.ops.getattr("/f")
+        self.assertEqual(self.client.count("read"), reads)
+
+    def test_lists_root_basedir(self):
+        self.ops = EtcdFSOperations(self.client, "/")
+        self.assertEqual(self.names("/"), [".", "..", "base"])
+
+
+class PathToKeyTestCase(unittest.TestCase):
+
+    def test_root_basedir(self):
+        ops = EtcdFSOperations(None, "/")
+        self.assertEqual(ops._path_to_key("/"), "/")
+        self.assertEqual(ops._path_to_key("/f"), "/f")
+        self.assertEqual(ops._path_to_key("/d/f/"), "/d/f")
+
+    def test_basedir(self):
+        ops = EtcdFSOperations(None, "base/")
+        self.assertEqual(ops._path_to_key("/"), "/base")
+        self.assertEqual(ops._path_to_key("/f"), "/base/f")
+        self.assertEqual(ops._path_to_key("//d/f/"), "/base/d/f")
+
+    def test_conversions_are_memoized_per_basedir(self):
+        etcdfs._path_to_key.cache_clear()
+        root = EtcdFSOperations(None, "/")
+        base = EtcdFSOperations(None, "/base")
+        self.assertEqual(root._path_to_key("/f"), "/f")
+        self.assertEqual(base._path_to_key("/f"), "/base/f")
+        self.assertEqual(base._path_to_key("/f"), "/base/f")
+        self.assertEqual(etcdfs._path_to_key.cache_info().hits, 1)
+
+
+class RecordingPool(object):
+    """Executor that keeps submitted tasks until they are run."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, func, *args):
+        self.tasks.append((func, args))
+
+    def run(self):
+        tasks, self.tasks = self.tasks, []
+        for func, args in tasks:
+            func(*args)
+
+
+class PrefetchTestCase(EtcdFSTestCase):
+
+    def setUp(self):
+        super(PrefetchTestCase, self).setUp()
+        self.ops = EtcdFSOperations(self.client, "/base", prefetch=True)
+        self.ops._pool = self.pool = RecordingPool()
+        self.count = etcdfs.PREFETCH_MAX_PENDING + 10
+        for i in range(self.count):
+            self.client.set("/base/d%03d" % i, None, dir=True)
+
+    def test_pending_prefetches_are_bounded(self):
+        self.ops.readdir("/", 0)
+        self.assertEqual(len(self.pool.tasks), etcdfs.PREFETCH_MAX_PENDING)
+        self.ops.readdir("/", 0)
+        self.assertEqual(len(self.pool.tasks), etcdfs.PREFETCH_MAX_PENDING)
+        self.pool.run()
+        self.assertEqual(self.ops._prefetch_pending, 0)
+        self.ops.readdir("/", 0)
+        self.assertEqual(len(self.pool.tasks),
+                         self.count - etcdfs.PREFETCH_MAX_PENDING)
+
+    def test_prefetched_directories_are_skipped(self):
+        self.ops.readdir("/", 0)
+        self.pool.run()
+        self.ops.readdir("/", 0)
+        self.pool.run()
+        self.ops.readdir("/", 0)
+        self.assertEqual(self.pool.tasks, [])
+
+    def test_prefetch_caches_entries(self):
+        self.client.set("/base/d000/f", "abc")
+        self.ops.readdir("/", 0)
+        self.pool.run()
+        reads = self.client.count("read")
+        self.assertEqual(self.ops.getattr("/d000/f")["st_size"], 3)
+        self.assertEqual(self.client.count("read"), reads)
+
+
+class StopWatch(Exception):
+    """Raised by the fake client to end the watch loop."""
+
+
+class WatchTestCase(EtcdFSTestCase):
+
+    def setUp(self):
+        super(WatchTestCase, self).setUp()
+        self.retry_interval = etcdfs.WATCH_RETRY_INTERVAL
+        etcdfs.WATCH_RETRY_INTERVAL = 0
+
+    def tearDown(self):
+        etcdfs.WATCH_RETRY_INTERVAL = self.retry_interval
+
+    def watch_indexes(self):
+        return [call[2] for call in self.client.calls if call[0] == "watch"]
+
+    def test_watch_resumes_from_known_index(self):
+        self.client.set("/base/f", "a")
+        event = self.client.result("/base/f", action="set")
+        self.ops.getattr("/f")
+        seed = self.client.index + 1
+        self.client.watch_results = [etcd.EtcdWatchTimedOut("timeout"),
+                                     event,
+                                     etcd.EtcdConnectionFailed("failed"),
+                                     StopWatch()]
+        self.assertRaises(StopWatch, self.ops._watch_loop)
+        self.assertEqual(self.watch_indexes(),
+                         [seed, seed, event.modifiedIndex + 1, seed])
+        self.assertEqual(len(self.ops._attr_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()